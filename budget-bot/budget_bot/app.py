@@ -1,12 +1,20 @@
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import logging
 import os
 import boto3
-from datetime import datetime, timedelta
+from botocore.config import Config
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 import time
+from functools import lru_cache
+from collections import OrderedDict
+import threading
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,22 +23,404 @@ logger.setLevel(logging.INFO)
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 DYNAMODB_TABLE = os.environ.get("DYNAMODB_TABLE", "ProcessedMessages-1")  # DynamoDB table name
+USER_TIMESTAMP_INDEX = os.environ.get("USER_TIMESTAMP_INDEX", "username-timestamp-index")  # GSI (username, timestamp)
+USER_TIMESTAMP_INDEX_KEYS_ONLY = os.environ.get("USER_TIMESTAMP_INDEX_PROJECTION", "ALL") == "KEYS_ONLY"  # Hydrate query hits with BatchGetItem
+
+# DynamoDB batch operations
+BATCH_WRITE_SIZE = 25  # BatchWriteItem limit per request
+BATCH_GET_SIZE = 100  # BatchGetItem limit per request
+BATCH_MAX_RETRIES = 5
+
+# Processed-message markers only need to outlive Telegram's webhook redelivery
+PROCESSED_MARKER_TTL = 24 * 60 * 60  # Seconds
+
+# Pending deletion confirmations live in the table so any warm container can see them
+DELETION_CONFIRMATION_TTL = 300  # Seconds a confirmation code stays valid
+DELETION_MAX_COUNT = 2000  # Most expenses one count-based request keeps IDs for; ~130 KB, under the 400 KB item limit
+DELETION_ATTRIBUTES = ["message_id", "timestamp", "amount", "description"]  # All the deletion flow reads of an expense
+
+# Gemini responses cached per warm container, keyed by the normalized prompt
+GEMINI_CACHE_SIZE = 512
+GEMINI_CACHE_TTL = 3600  # Seconds before a cached response is fetched again
+FAST_PATH_MAX_TOKENS = 6  # Longer messages always go to Gemini
+FALLBACK_CACHE_SIZE = 256  # Local amount/category extractions, reused when Gemini is failing
+
+# HTTP timeouts in seconds; requests take (connect, read) pairs
+HTTP_CONNECT_TIMEOUT = 3
+TELEGRAM_READ_TIMEOUT = 8
+
+# Telegram send limits: 30 messages/second per bot, 20/minute per chat
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 20 / 60
+TELEGRAM_CHAT_BURST = 20
+TELEGRAM_MAX_RETRY_AFTER = 2  # Longest 429 retry_after worth waiting for inside the Lambda timeout
+TELEGRAM_SEND_RESERVE = 0.5  # Seconds kept back for the send itself when deciding how long to queue
+TELEGRAM_CHAT_BUCKETS_MAX = 1024  # Per-chat limiters kept per container, least recently used evicted first
 
 # API Endpoints
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+TELEGRAM_CHAT_ACTION_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendChatAction"
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 
-# Initialize DynamoDB client
-dynamodb = boto3.client("dynamodb")
+# Precompiled regex patterns
+_QUERY_GUARD_RE = re.compile(r'(?:show|display|list|my expenses|total)')
+_NUM_RE = re.compile(r'\d+')
+_AMOUNT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(k|thousand|l|lakh|lakhs|cr|crore|crores)?')
+_CONFIRM_RE = re.compile(r'confirm\s+(\w+)')
+
+# Factors for the multiplier words _AMOUNT_RE accepts right after the number
+_AMOUNT_MULTIPLIERS = {
+    "k": 1_000, "thousand": 1_000,
+    "l": 100_000, "lakh": 100_000, "lakhs": 100_000,
+    "cr": 10_000_000, "crore": 10_000_000, "crores": 10_000_000
+}
+_MULTIPLIER_WORDS = frozenset(_AMOUNT_MULTIPLIERS)
+
+# Decoder for pulling the first JSON object out of Gemini's free-text replies
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_first_json(text):
+    """ Decode the first JSON object embedded in text, or None if there isn't a valid one """
+    # Fast path: the reply is just the object, possibly inside a ```json fence
+    stripped = text.strip().removeprefix("```json").removesuffix("```")
+    try:
+        data = orjson.loads(stripped)
+        if isinstance(data, dict):
+            return data
+    except orjson.JSONDecodeError:
+        pass
+    
+    start = text.find("{")
+    if start < 0:
+        return None
+    try:
+        return _JSON_DECODER.raw_decode(text, start)[0]
+    except ValueError:
+        return None
+
+
+def _any_of(words):
+    """ Compile a list of plain substrings into one alternation regex """
+    return re.compile("|".join(re.escape(word) for word in words))
+
+
+def _keyword_trie_pattern(words):
+    """ Compile words into a regex alternation shaped like a prefix trie, so each position
+    is dispatched on its next character instead of trying every word in turn """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}  # Marks the end of a word
+    
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in node.items() if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # Greedy optional tail: the longest word starting at a position is the one reported
+        return f"(?:{body})?" if "" in node else body
+    
+    return emit(trie)
+
+
+# Keyword groups used to route messages; each is matched as a plain substring in one regex pass
+_SHOW_VARIANTS = ["show", "shwo", "shoq", "sho", "sbow"]  # Common typos for "show"
+_SHOW_QUERY_RE = re.compile(
+    f"(?:{'|'.join(_SHOW_VARIANTS)}) (?:my expenses|expenses|my transactions)"
+)
+_DIRECT_QUERY_RE = _any_of([
+    "my expenses", "what did i spend", "how much did i spend",
+    "total expenses", "expense report", "spending summary"
+])
+_QUERY_KW_RE = _any_of([
+    "show", "shwo", "list", "display", "tell me", "what", "how much",
+    "total", "summary", "report", "analysis", "breakdown"
+])
+_EXPENSE_TERM_RE = _any_of(["expense", "spent", "spend", "cost", "payment"])
+_DELETE_KW_RE = _any_of(["delete", "remove", "erase", "clear", "clean", "wipe", "purge"])
+_DELETE_TARGET_RE = _any_of(["expense", "expenses", "history", "data", "records", "transactions"])
+
+# All routing checks in one anchored regex: the branches are tried in priority order and
+# the empty named group of the first one that matches names the route (lastgroup).
+# A message matching none of them is treated as an expense entry
+_ROUTER_RE = re.compile(
+    "|".join([
+        f"(?=.*?(?:{_DELETE_KW_RE.pattern}))(?=.*?(?:{_DELETE_TARGET_RE.pattern}))(?P<delete>)",
+        f"(?:(?=.*?(?:{_SHOW_QUERY_RE.pattern}|{_DIRECT_QUERY_RE.pattern}))"
+        f"|(?=.*?(?:{_QUERY_KW_RE.pattern}))(?=.*?(?:{_EXPENSE_TERM_RE.pattern})))(?P<query>)",
+        f"(?=.*?{_QUERY_GUARD_RE.pattern})(?P<guarded>)",
+    ]),
+    re.DOTALL
+)
+
+# Fallback category keywords, checked in order (the first category with any match wins)
+_CATEGORY_KEYWORDS = {
+    'Food': ['food', 'meal', 'lunch', 'dinner', 'breakfast', 'restaurant', 'eat', 'coffee', 'tea', 'cafe'],
+    'Groceries': ['grocery', 'groceries', 'supermarket', 'fruit', 'vegetable'],
+    'Transport': ['uber', 'ola', 'taxi', 'auto', 'transport', 'travel', 'bus', 'train', 'metro'],
+    'Vehicle': ['car', 'bike', 'cycle', 'repair', 'service', 'motor', 'fuel', 'petrol', 'diesel'],
+    'Bills': ['bill', 'recharge', 'subscription', 'electricity', 'water', 'internet', 'phone bill'],
+    'Health': ['medicine', 'doctor', 'hospital', 'medical', 'health', 'clinic', 'dentist'],
+    'Fashion': ['clothes', 'dress', 'shirt', 'pant', 'shoe', 'footwear', 'apparel', 'fashion'],
+    'Electronics': ['phone', 'mobile', 'laptop', 'computer', 'gadget', 'electronics', 'device'],
+    'Entertainment': ['movie', 'game', 'show', 'concert', 'entertainment', 'theatre', 'amusement'],
+    'Education': ['book', 'course', 'class', 'tuition', 'school', 'college', 'education']
+}
+
+# Category keyword matching in a single scan: the lookahead reports the longest keyword
+# starting at every position. Each keyword is ranked by the best (earliest) category among
+# itself and the keywords it starts with, since those share its start position
+_CATEGORY_NAMES = list(_CATEGORY_KEYWORDS)
+_KEYWORD_RANK = {
+    keyword: min(
+        rank
+        for rank, keywords in enumerate(_CATEGORY_KEYWORDS.values())
+        for prefix in keywords
+        if keyword.startswith(prefix)
+    )
+    for keywords in _CATEGORY_KEYWORDS.values()
+    for keyword in keywords
+}
+_CATEGORY_RE = re.compile(f"(?=({_keyword_trie_pattern(_KEYWORD_RANK)}))")
+
+# Keywords the local fast path must not decide on, because _EXPENSE_SYSTEM_PROMPT files them
+# differently: fuel goes under Transport there, and groceries is listed under both Food and Groceries
+_FAST_PATH_CONFLICTS = frozenset(["fuel", "petrol", "diesel", "grocery", "groceries"])
+
+# Friendly replies per category when Gemini is unavailable
+_FALLBACK_MESSAGES = {
+    'Electronics': "New gadget! 📱 Your electronics purchase has been logged. Enjoy your new device!",
+    'Bills': "Payment noted! 🧾 I've recorded your bill payment. Keeping your expenses organized!",
+    'Food': "Yum! 🍔 I've added your food expense to your tracker. Bon appétit!",
+    'Transport': "On the move! 🚗 I've logged your transport expense. Safe travels!",
+    'Miscellaneous': "Got it! 💰 Your expense has been recorded. Thanks for keeping track!"
+}
+
+# Usage instructions sent when a message isn't an expense, query or deletion
+HELPFUL_MESSAGE = """
+<b>👋 Hello! I'm your Expense Tracker Assistant!</b>
+
+I can help you track expenses and provide insights about your spending habits.
+
+<b>Here's how you can use me:</b>
+
+<b>1️⃣ To record expenses, try formats like:</b>
+• "taxi 300"
+• "spent 500 on dinner"
+• "bought shoes for 3000"
+• "purchased phone for 15000"
+• "2000 for rent"
+• "1.5L for laptop" (I understand ₹, k, L and Cr formats)
+
+<b>2️⃣ To review your expenses, ask me:</b>
+• "show my expenses"
+• "what did I spend today"
+• "show my last expense"
+• "show my recent X expense"
+• "show my expenses from last week"
+• "what are my total expenses this month"
+
+<b>3️⃣ To clean up your expenses:</b>
+• "delete all my expenses"
+• "delete my recent X expenses"
+• "erase my expenses from last month"
+• "clear my expense history"
+
+<b>3️⃣ To clean up your expenses:</b>
+Just tell me what you bought and how much it cost, or ask about your spending history!
+"""
+
+# Gemini instructions for turning an expense message into amount, category and a reply
+_EXPENSE_SYSTEM_PROMPT = """You are a smart expense tracking assistant for Indian users. Analyze the user's expense message and:
+
+1. Extract numerical amount in any format (₹500, 5k, 1.5L, 4L, 1Cr etc.) - where k=thousand, L = Lakh (100,000) and Cr = Crore (10,000,000)
+2. Determine the most appropriate category from this list:
+   - Food (meals, restaurants, snacks, groceries, dining, coffee, tea, beverages)
+   - Groceries (supermarket, fruits, vegetables, household items)
+   - Transport (uber, ola, taxi, auto, bus, metro, fuel, travel)
+   - Vehicle (car, bike, cycle, repair, servicing, automotive, motor)
+   - Bills (electricity, water, internet, recharges, subscriptions)
+   - Health (medicines, doctor visits, hospital, medical)
+   - Fashion (clothes, shoes, frocks, dresses, accessories, footwear)
+   - Electronics (gadgets, phones, iphone, smartphone, laptop, computer, devices)
+   - Personal Care (haircut, spa, cosmetics, grooming)
+   - Education (books, courses, tuition, coaching)
+   - Entertainment (movies, games, events, recreation)
+   - Shopping (general purchases)
+   - Home (furniture, decor, appliances, housing)
+   - Miscellaneous (anything else)
+3. Generate a friendly response message in English (20-30 words) with emojis.
+4. Return JSON format: {"amount": number, "category": string, "message": string}
+
+IMPORTANT: Be extremely flexible in understanding expense formats. Extract any number and make a reasonable guess at the category.
+Always return a valid numerical amount and category even if you have to guess based on limited information.
+"""
+
+# Gemini instructions for reading the time range and limit out of an expense query
+_TIME_RANGE_SYSTEM_PROMPT = """You are an expense tracking assistant. Analyze the user's query about their expenses and extract the time range and limit.
+    
+    Return a JSON with the following format:
+    {
+        "days": number,
+        "description": "human readable description of the time period",
+        "limit": number (number of transactions to show, null for all)
+    }
+    
+    Examples:
+    - "show my last expense" → {"days": 30, "description": "last expense", "limit": 1}
+    - "show my last transaction" → {"days": 30, "description": "last expense", "limit": 1}
+    - "show my all transactions" → {"days": 30, "description": "last expense", "limit": 1}
+    - "show my last expense only" → {"days": 30, "description": "last expense", "limit": 1}
+    - "what did I spend today" → {"days": 1, "description": "today", "limit": null}
+    - "show my expenses from last week" → {"days": 7, "description": "last week", "limit": null}
+    - "how much did I spend this month" → {"days": 30, "description": "this month", "limit": null}
+    - "expenses in the last 3 days" → {"days": 3, "description": "last 3 days", "limit": null}
+    - "show all my expenses" → {"days": 90, "description": "all expenses", "limit": null}
+    - "show my recent 5 expenses" → {"days": 30, "description": "recent expenses", "limit": 5}
+    
+    Be very attentive to phrases like "last expense", "last transaction", "recent expense" which indicate the user wants to see only the most recent expense.
+    """
+
+# Gemini instructions for reading the time range or count out of a deletion request
+_DELETION_SYSTEM_PROMPT = """You are an expense tracking assistant. Analyze the user's request to delete their expense history and extract either a time range or a count of recent expenses.
+    
+    Return a JSON with the following format:
+    {
+        "days": number or null,
+        "description": "human readable description of what to delete",
+        "count": number or null,
+        "position": string or null (possible values: "first", "last", or null)
+    }
+    
+    Examples:
+    - "delete all my expenses" → {"days": null, "description": "all expenses", "count": null, "position": null}
+    - "erase my expenses from last week" → {"days": 7, "description": "last week", "count": null, "position": null}
+    - "clear my expense history for this month" → {"days": 30, "description": "this month", "count": null, "position": null}
+    - "remove my expenses from last 3 days" → {"days": 3, "description": "last 3 days", "count": null, "position": null}
+    - "delete my last 2 expenses" → {"days": null, "description": "last 2 expenses", "count": 2, "position": "last"}
+    - "delete first 2 expenses" → {"days": null, "description": "first 2 expenses", "count": 2, "position": "first"}
+    - "delete my recent 5 expenses" → {"days": null, "description": "last 5 expenses", "count": 5, "position": "last"}
+    
+    IMPORTANT: Pay careful attention to words like "first" or "last" when deleting a specific number of expenses.
+    - "first N expenses" means the oldest N expenses (top of the list)
+    - "last N expenses" means the most recent N expenses (shown first in the list)
+    - If no position is specified, assume "last" (most recent)
+    """
+
+# Category emojis as single codepoints (variation selectors stripped), so a message is
+# classified with one C-level set intersection over its characters
+_ELECTRONICS_EMOJIS = frozenset(e.rstrip("\ufe0f") for e in ["💻", "📱", "⌚", "🖥️", "🖨️", "📷", "🎮"])
+_FOOD_EMOJIS = frozenset(["🍕", "🍔", "🍟", "🍗", "🍖", "🥗", "🍣", "🍩", "🍦", "🍨", "🧁", "🍰", "🍪"])
+_TRANSPORT_EMOJIS = frozenset(e.rstrip("\ufe0f") for e in ["🚗", "🚕", "🚌", "🚆", "✈️", "🛵", "🚲", "🚅", "🚄"])
+_ALL_EMOJIS = _ELECTRONICS_EMOJIS | _FOOD_EMOJIS | _TRANSPORT_EMOJIS
+
+# DynamoDB client, created lazily so requests rejected before any DynamoDB work never pay for it
+@lru_cache(maxsize=1)
+def _ddb():
+    """ The container's DynamoDB client, kept so connections stay alive between warm invocations """
+    return boto3.client(
+        "dynamodb",
+        config=Config(
+            retries={"max_attempts": 3, "mode": "standard"},
+            tcp_keepalive=True,
+            max_pool_connections=10
+        )
+    )
+
+# Shared HTTP session, so warm invocations reuse TCP/TLS connections to Gemini and Telegram
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=2,
+        read=False,  # Never re-send once the request may have been delivered (duplicate replies, double billing)
+        backoff_factor=0.2,
+        status_forcelist=(503,),  # Only a status that means the request wasn't acted on; 429 is handled by callers
+        respect_retry_after_header=False,  # An uncapped Retry-After could outlast the Lambda timeout
+        allowed_methods=frozenset(["POST"]),  # Both APIs are called with POST only
+        raise_on_status=False
+    )
+))
+
+# Gemini response cache ((prompt kind, normalized message) -> (expires_at, response text)), shared with worker threads
+_GEMINI_CACHE = OrderedDict()
+_GEMINI_CACHE_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """ Token-bucket rate limiter refilling `rate` tokens per second, holding at most `burst` """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait=float("inf")):
+        """ Take a token, sleeping until it's available; callers queue up by going into debt.
+        Returns False without taking a token if that would mean sleeping longer than max_wait """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0
+            if wait > max_wait:
+                return False
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+# Outbound Telegram limiters for this container: one for the bot, one per chat
+_TELEGRAM_BUCKET = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+_TELEGRAM_CHAT_BUCKETS = OrderedDict()
+_TELEGRAM_CHAT_BUCKETS_LOCK = threading.Lock()
+
+# Monotonic time at which the invocation in progress times out (one at a time per container); None outside Lambda
+_invocation_deadline = None
+
+
+def chat_bucket(chat_id):
+    """ The chat's rate limiter, keeping only the most recently used chats' limiters """
+    with _TELEGRAM_CHAT_BUCKETS_LOCK:
+        bucket = _TELEGRAM_CHAT_BUCKETS.get(chat_id)
+        if bucket is None:
+            bucket = _TELEGRAM_CHAT_BUCKETS[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            if len(_TELEGRAM_CHAT_BUCKETS) > TELEGRAM_CHAT_BUCKETS_MAX:
+                _TELEGRAM_CHAT_BUCKETS.popitem(last=False)
+        else:
+            _TELEGRAM_CHAT_BUCKETS.move_to_end(chat_id)
+        return bucket
+
+
+def send_budget():
+    """ Seconds a Telegram send may still spend waiting before the invocation would time out """
+    if _invocation_deadline is None:
+        return float("inf")
+    return _invocation_deadline - time.monotonic() - TELEGRAM_SEND_RESERVE
+
+# Worker threads for overlapping independent DynamoDB / HTTP calls within an invocation
+_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+def utc_now():
+    """ Naive UTC datetime, matching the ISO timestamps already stored in DynamoDB """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-# Store deletion confirmations temporarily (userId -> confirmation data)
-deletion_confirmations = {}
 
 def lambda_handler(event, context):
+    global _invocation_deadline
+    _invocation_deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 if context else None
     try:
-        logger.info(f"🔍 Received event: {json.dumps(event, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔍 Received event: %s", orjson.dumps(event).decode())
         
-        body = json.loads(event.get("body", "{}"))
+        body = orjson.loads(event.get("body") or "{}")
         message = body.get("message", {})
 
         chat_id = message.get("chat", {}).get("id")
@@ -40,131 +430,119 @@ def lambda_handler(event, context):
 
         if not chat_id or not text:
             logger.error("🚨 Missing chat_id or text!")
-            return {"statusCode": 400, "body": json.dumps({"message": "Invalid request"})}
-
-        # Check if the message has already been processed
-        if check_if_processed(message_id):
+            return {"statusCode": 400, "body": orjson.dumps({"message": "Invalid request"}).decode()}
+
+        # Route without side effects, up front, so the Gemini analysis of an
+        # expense entry can overlap with the DynamoDB claim below
+        text_lower = text.lower()
+        route = route_message(text_lower)
+        logger.info(f"🧭 Routing message as {route or 'expense entry'}: {text}")
+        analysis_future = None
+        if (
+            username == "krupakar_reddy"
+            and not is_confirmation_reply(text_lower)
+            and route is None
+        ):
+            analysis_future = _EXECUTOR.submit(analyze_expense, text)
+
+        # Atomically mark the message as processed, skipping it if it already was
+        if not try_claim_message(message_id):
             logger.info(f"⚠️ Message ID {message_id} has already been processed. Skipping...")
-            return {"statusCode": 200, "body": json.dumps({"message": "Already processed"})}
-
-        # Mark message as processed in DynamoDB
-        mark_as_processed(message_id)
+            if analysis_future:
+                analysis_future.cancel()  # Never wait on Gemini for a redelivery; a call already running is just discarded
+            return {"statusCode": 200, "body": orjson.dumps({"message": "Already processed"}).decode()}
 
         # Restrict access to a specific user (krupakar_reddy)
         if username != "krupakar_reddy":
             logger.error(f"🚨 Unauthorized access attempt by {username}!")
             send_telegram_reply(chat_id, message_id, "You do not have access, Please send hi @krupakar_reddy here, if you need to explore the bot.")
-            return {"statusCode": 403, "body": json.dumps({"message": "You do not have access, Please send hi @krupakar_reddy here, if you need to explore the bot."})}
+            return {"statusCode": 403, "body": orjson.dumps({"message": "You do not have access, Please send hi @krupakar_reddy here, if you need to explore the bot."}).decode()}
 
             sys.exit(1)
 
         
         # Check if this is a confirmation for expense deletion
-        if is_deletion_confirmation(username, text):
-            handle_deletion_confirmation(chat_id, message_id, username, text)
-            return {"statusCode": 200, "body": json.dumps({"message": "Deletion confirmation processed"})}
+        # Only replies shaped like a confirmation or cancellation need the stored state, fetched once
+        confirmation_data = get_deletion_confirmation(username) if is_confirmation_reply(text_lower) else None
+        if is_deletion_confirmation(confirmation_data, text_lower):
+            handle_deletion_confirmation(chat_id, message_id, username, confirmation_data, text_lower)
+            return {"statusCode": 200, "body": orjson.dumps({"message": "Deletion confirmation processed"}).decode()}
         
+        # Show "typing..." while Gemini works on the message, unless the analysis already finished
+        typing_future = None
+        if route in ("delete", "query") or (analysis_future and not analysis_future.done()):
+            typing_future = _EXECUTOR.submit(send_chat_action, chat_id)
+
         # Check if this is a deletion request
-        if is_deletion_request(text):
+        if route == "delete":
             time_range = extract_deletion_time_range(text)
+            if typing_future:
+                typing_future.result()  # Let the chat action land before any reply clears it
             handle_deletion_request(chat_id, message_id, username, time_range)
-            return {"statusCode": 200, "body": json.dumps({"message": "Deletion request processed"})}
+            return {"statusCode": 200, "body": orjson.dumps({"message": "Deletion request processed"}).decode()}
 
         # Check if it's an expense query
-        if is_expense_query(text):
+        if route == "query":
             logger.info(f"Processing as expense QUERY: {text}")
             time_range = extract_time_range_from_query(text)
+            if typing_future:
+                typing_future.result()
             expenses = get_user_expenses(username, time_range)
             send_telegram_reply(chat_id, message_id, format_expense_summary(expenses, time_range))
-            return {"statusCode": 200, "body": json.dumps({"message": "Expense query processed"})}
+            return {"statusCode": 200, "body": orjson.dumps({"message": "Expense query processed"}).decode()}
         
         # Then check if it contains a number for potential expense entry
-        if not re.search(r'(?:show|display|list|my expenses|total)', text.lower()):
-            analysis = analyze_expense(text)
+        if route is None:
+            analysis = analysis_future.result() if analysis_future else analyze_expense(text)
+            if typing_future:
+                typing_future.result()
 
             if analysis.get('amount') and analysis['amount'] != "???":
                 try:
                     amount = float(str(analysis['amount']).replace(",", "").strip())
 
                     if amount > 0:
-                        store_user_expense(username, analysis, text)
+                        # Store the expense and send the confirmation concurrently; neither depends on the other
+                        store_future = _EXECUTOR.submit(store_user_expense, username, analysis, text)
 
                         # Simple confirmation for expense entry
                         response_text = f"₹{amount} marked under <b>{analysis['category']}</b> expenses. <i>{analysis['message']}</i>"
                         send_telegram_reply(chat_id, message_id, response_text)
-                        return {"statusCode": 200, "body": json.dumps({"message": "Expense processed"})}
+                        store_future.result()
+                        return {"statusCode": 200, "body": orjson.dumps({"message": "Expense processed"}).decode()}
                 
                 except ValueError as e:
                     logger.error(f"🔥 Invalid amount format: {analysis['amount']}, error: {e}")
 
         # If we get here, it's not a clear expense or query - show helpful message
-        helpful_message = """
-<b>👋 Hello! I'm your Expense Tracker Assistant!</b>
-
-I can help you track expenses and provide insights about your spending habits.
-
-<b>Here's how you can use me:</b>
-
-<b>1️⃣ To record expenses, try formats like:</b>
-• "taxi 300"
-• "spent 500 on dinner"
-• "bought shoes for 3000"
-• "purchased phone for 15000"
-• "2000 for rent"
-• "1.5L for laptop" (I understand ₹, k, L and Cr formats)
-
-<b>2️⃣ To review your expenses, ask me:</b>
-• "show my expenses"
-• "what did I spend today"
-• "show my last expense"
-• "show my recent X expense"
-• "show my expenses from last week"
-• "what are my total expenses this month"
-
-<b>3️⃣ To clean up your expenses:</b>
-• "delete all my expenses"
-• "delete my recent X expenses"
-• "erase my expenses from last month"
-• "clear my expense history"
-
-<b>3️⃣ To clean up your expenses:</b>
-Just tell me what you bought and how much it cost, or ask about your spending history!
-"""
-        send_telegram_reply(chat_id, message_id, helpful_message)
-        return {"statusCode": 200, "body": json.dumps({"message": "Instructions sent"})}
+        send_telegram_reply(chat_id, message_id, HELPFUL_MESSAGE)
+        return {"statusCode": 200, "body": orjson.dumps({"message": "Instructions sent"}).decode()}
         
     except Exception as e:
         logger.error(f"🔥 Error processing request: {str(e)}", exc_info=True)
-        return {"statusCode": 500, "body": json.dumps({"message": "Internal Server Error"})}
-
-
-def check_if_processed(message_id):
-    """ Check DynamoDB if the message has already been processed """
-    try:
-        response = dynamodb.get_item(
-            TableName=DYNAMODB_TABLE,
-            Key={"message_id": {"S": f"MSG#{message_id}"}},
-            ConsistentRead=True  # Ensure latest data is read
-        )
-        return "Item" in response  # True if item exists, False otherwise
-    except Exception as e:
-        logger.error(f"⚠️ Error checking DynamoDB: {str(e)}")
-        return False  # Return False to avoid skipping transactions incorrectly
+        return {"statusCode": 500, "body": orjson.dumps({"message": "Internal Server Error"}).decode()}
 
 
-def mark_as_processed(message_id):
-    """ Mark a message as processed in DynamoDB """
+def try_claim_message(message_id):
+    """ Mark a message as processed in DynamoDB with a single conditional write.
+    Returns False if it had already been processed """
     try:
-        dynamodb.put_item(
+        _ddb().put_item(
             TableName=DYNAMODB_TABLE,
             Item={
                 "message_id": {"S": f"MSG#{message_id}"},
-                "processed_at": {"S": datetime.utcnow().isoformat()}
-            }
+                "processed_at": {"S": utc_now().isoformat()},
+                "expires_at": {"N": str(int(time.time()) + PROCESSED_MARKER_TTL)}  # Removed by the table's TTL
+            },
+            ConditionExpression="attribute_not_exists(message_id)"
         )
         logger.info(f"✅ Marked message {message_id} as processed.")
+        return True
+    except _ddb().exceptions.ConditionalCheckFailedException:
+        return False
     except Exception as e:
         logger.error(f"⚠️ Error marking message in DynamoDB: {str(e)}")
+        return True  # Return True to avoid skipping transactions incorrectly
 
 def store_user_expense(username, analysis, original_text):
     """ Store user expense in DynamoDB """
@@ -176,14 +554,14 @@ def store_user_expense(username, analysis, original_text):
             logger.info(f"Skipping expense with zero or negative amount: {amount}")
             return
             
-        timestamp = datetime.utcnow().isoformat()
+        timestamp = utc_now().isoformat()
         expense_id = f"EXP#{username}#{timestamp}"
         
         # Log for debugging
         logger.info(f"Storing expense for user {username}: {analysis}")
         
         # Store in DynamoDB
-        dynamodb.put_item(
+        _ddb().put_item(
             TableName=DYNAMODB_TABLE,
             Item={
                 "message_id": {"S": expense_id},
@@ -203,104 +581,71 @@ def store_user_expense(username, analysis, original_text):
         logger.error(f"⚠️ Error storing expense: {str(e)}")
 
         
-def is_expense_query(text):
-    """Check if text is asking about past expenses with typo tolerance"""
-    text_lower = text.lower()
-    
-    # Common typos for "show"
-    show_variants = ["show", "shwo", "shoq", "sho", "sbow"]
-    
-    # Direct matches for common query phrases with typo tolerance
-    for show_variant in show_variants:
-        direct_queries = [
-            f"{show_variant} my expenses",
-            f"{show_variant} expenses", 
-            f"{show_variant} my transactions"
-        ]
-        if any(query in text_lower for query in direct_queries):
-            logger.info(f"Detected as expense query (direct match with typo tolerance): {text_lower}")
-            return True
-    
-    # Other direct phrases that don't depend on "show"
-    other_direct_queries = [
-        "my expenses",
-        "what did i spend",
-        "how much did i spend",
-        "total expenses",
-        "expense report",
-        "spending summary"
-    ]
+def route_message(text_lower):
+    """ Classify a lowercased message as "delete", "query", "guarded" or None (expense entry) """
+    match = _ROUTER_RE.match(text_lower)
+    return match.lastgroup if match else None
+
+
+def normalize_prompt(text):
+    """ Lowercase and collapse whitespace so equivalent messages share a Gemini cache key; Gemini still gets the original """
+    return " ".join(text.lower().split())
+
+
+def gemini_generate(prompt_text, timeout):
+    """ Send a prompt to Gemini and return the text of the first candidate """
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt_text}]
+        }]
+    }
+
+    response = _HTTP.post(
+        f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+        json=payload,
+        timeout=timeout
+    )
     
-    if any(query in text_lower for query in other_direct_queries):
-        logger.info(f"Detected as expense query (direct match): {text_lower}")
-        return True
+    response.raise_for_status()
+    result = orjson.loads(response.content)
     
-    # Keywords that indicate a query
-    query_keywords = [
-        "show", "shwo", "list", "display", "tell me", "what", "how much", 
-        "total", "summary", "report", "analysis", "breakdown"
-    ]
+    return result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+
+
+def gemini_generate_cached(prompt_text, timeout, cache_key):
+    """ gemini_generate behind a per-container LRU cache with expiry, keyed by cache_key; failed calls raise and are not cached """
+    now = time.monotonic()
+    with _GEMINI_CACHE_LOCK:
+        entry = _GEMINI_CACHE.get(cache_key)
+        if entry is not None:
+            if entry[0] > now:
+                _GEMINI_CACHE.move_to_end(cache_key)
+                return entry[1]
+            del _GEMINI_CACHE[cache_key]  # Expired
     
-    # Must include both a query keyword and 'expense'/'spent'/'spend' term
-    has_query_keyword = any(keyword in text_lower for keyword in query_keywords)
-    has_expense_term = any(term in text_lower for term in ["expense", "spent", "spend", "cost", "payment"])
+    response_text = gemini_generate(prompt_text, timeout)
     
-    if has_query_keyword and has_expense_term:
-        logger.info(f"Detected as expense query (keyword + expense term): {text_lower}")
-        return True
+    with _GEMINI_CACHE_LOCK:
+        _GEMINI_CACHE[cache_key] = (now + GEMINI_CACHE_TTL, response_text)
+        _GEMINI_CACHE.move_to_end(cache_key)
+        if len(_GEMINI_CACHE) > GEMINI_CACHE_SIZE:
+            _GEMINI_CACHE.popitem(last=False)  # Evict the least recently used
     
-    logger.info(f"Not detected as expense query: {text_lower}")
-    return False
+    return response_text
 
 
 def extract_time_range_from_query(query):
     """ Extract time range from query using Gemini API """
-    system_prompt = """You are an expense tracking assistant. Analyze the user's query about their expenses and extract the time range and limit.
-    
-    Return a JSON with the following format:
-    {
-        "days": number,
-        "description": "human readable description of the time period",
-        "limit": number (number of transactions to show, null for all)
-    }
-    
-    Examples:
-    - "show my last expense" → {"days": 30, "description": "last expense", "limit": 1}
-    - "show my last transaction" → {"days": 30, "description": "last expense", "limit": 1}
-    - "show my all transactions" → {"days": 30, "description": "last expense", "limit": 1}
-    - "show my last expense only" → {"days": 30, "description": "last expense", "limit": 1}
-    - "what did I spend today" → {"days": 1, "description": "today", "limit": null}
-    - "show my expenses from last week" → {"days": 7, "description": "last week", "limit": null}
-    - "how much did I spend this month" → {"days": 30, "description": "this month", "limit": null}
-    - "expenses in the last 3 days" → {"days": 3, "description": "last 3 days", "limit": null}
-    - "show all my expenses" → {"days": 90, "description": "all expenses", "limit": null}
-    - "show my recent 5 expenses" → {"days": 30, "description": "recent expenses", "limit": 5}
-    
-    Be very attentive to phrases like "last expense", "last transaction", "recent expense" which indicate the user wants to see only the most recent expense.
-    """
-
-    payload = {
-        "contents": [{
-            "parts": [{"text": f"{system_prompt}\n\nUser query: {query}"}]
-        }]
-    }
-
     try:
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            json=payload,
-            timeout=8
+        response_text = gemini_generate_cached(
+            f"{_TIME_RANGE_SYSTEM_PROMPT}\n\nUser query: {query}",
+            (HTTP_CONNECT_TIMEOUT, 8),
+            ("query", normalize_prompt(query))
         )
         
-        response.raise_for_status()
-        result = response.json()
-        
-        response_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-        
         # Extract JSON from response
-        json_match = re.search(r'(\{.*\})', response_text, re.DOTALL)
-        if json_match:
-            time_range = json.loads(json_match.group(1))
+        time_range = _extract_first_json(response_text)
+        if time_range is not None:
             return {
                 "days": time_range.get("days", 30),
                 "description": time_range.get("description", "recent expenses"),
@@ -318,26 +663,13 @@ def get_user_expenses(username, time_range):
     try:
         # Calculate start time based on days
         days = time_range.get("days", 7)
-        start_time = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        start_time = (utc_now() - timedelta(days=days)).isoformat()
         
-        # Scan DynamoDB for expenses
-        response = dynamodb.scan(
-            TableName=DYNAMODB_TABLE,
-            FilterExpression="username = :u AND #type = :t AND #ts >= :st AND #amount > :zero",
-            ExpressionAttributeNames={
-                "#type": "type",
-                "#ts": "timestamp",
-                "#amount": "amount"
-            },
-            ExpressionAttributeValues={
-                ":u": {"S": username},
-                ":t": {"S": "EXPENSE"},
-                ":st": {"S": start_time},
-                ":zero": {"N": "0"}  # Filter out zero-amount expenses
-            }
-        )
+        # Only read as many items as will be shown when a limit is requested
+        limit = time_range.get("limit")
+        limit = int(limit) if limit is not None and limit > 0 else None
         
-        items = response.get('Items', [])
+        items = query_user_expenses(username, start_time, limit, positive_only=True)
         logger.info(f"Found {len(items)} expenses for user {username} in {time_range['description']}")
         return items
     except Exception as e:
@@ -345,6 +677,73 @@ def get_user_expenses(username, time_range):
         return []
 
 
+def query_user_expenses(username, start_time=None, limit=None, positive_only=False, attributes=None, end_time=None):
+    """ Query a user's expenses from the username/timestamp index, newest first, following pagination.
+    start_time/end_time bound the timestamps (inclusive); attributes optionally limits which item attributes are returned """
+    query_args = {
+        "TableName": DYNAMODB_TABLE,
+        "IndexName": USER_TIMESTAMP_INDEX,
+        "KeyConditionExpression": "username = :u",
+        "ExpressionAttributeValues": {
+            ":u": {"S": username}
+        },
+        "ScanIndexForward": False
+    }
+    names = {}
+    
+    # The time range is part of the key condition, so nothing outside it is read
+    if start_time is not None and end_time is not None:
+        query_args["KeyConditionExpression"] += " AND #ts BETWEEN :st AND :et"
+    elif start_time is not None:
+        query_args["KeyConditionExpression"] += " AND #ts >= :st"
+    elif end_time is not None:
+        query_args["KeyConditionExpression"] += " AND #ts <= :et"
+    if start_time is not None:
+        query_args["ExpressionAttributeValues"][":st"] = {"S": start_time}
+    if end_time is not None:
+        query_args["ExpressionAttributeValues"][":et"] = {"S": end_time}
+    if start_time is not None or end_time is not None:
+        names["#ts"] = "timestamp"
+    
+    # A keys-only index can't filter on type/amount; those hits are filtered after hydration
+    if not USER_TIMESTAMP_INDEX_KEYS_ONLY:
+        query_args["FilterExpression"] = "#type = :t"
+        names["#type"] = "type"
+        query_args["ExpressionAttributeValues"][":t"] = {"S": "EXPENSE"}
+        if positive_only:
+            query_args["FilterExpression"] += " AND #amount > :zero"
+            names["#amount"] = "amount"
+            query_args["ExpressionAttributeValues"][":zero"] = {"N": "0"}  # Filter out zero-amount expenses
+    
+    # Keys-only hits are hydrated whole, since the type/amount checks need those attributes
+    if attributes and not USER_TIMESTAMP_INDEX_KEYS_ONLY:
+        placeholders = [f"#p{i}" for i in range(len(attributes))]
+        names.update(zip(placeholders, attributes))
+        query_args["ProjectionExpression"] = ", ".join(placeholders)
+    
+    if names:
+        query_args["ExpressionAttributeNames"] = names
+    if limit:
+        query_args["Limit"] = limit
+    
+    items = []
+    while True:
+        response = _ddb().query(**query_args)
+        page = response.get('Items', [])
+        if USER_TIMESTAMP_INDEX_KEYS_ONLY:
+            page = [
+                item for item in batch_get_expenses([key["message_id"]["S"] for key in page])
+                if item.get("type", {}).get("S") == "EXPENSE"
+                and (not positive_only or float(item["amount"]["N"]) > 0)
+            ]
+        items.extend(page)
+        if "LastEvaluatedKey" not in response or (limit and len(items) >= limit):
+            break
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    
+    return items[:limit] if limit else items
+
+
 def format_expense_summary(expenses, time_range, threshold=None):
     """ Format expenses into a readable summary """
     if threshold is None:
@@ -354,8 +753,8 @@ def format_expense_summary(expenses, time_range, threshold=None):
         return f"No expenses found for {time_range['description']}! 💸"
     
     try:
-        # Sort expenses by timestamp (newest first)
-        sorted_expenses = sorted(expenses, key=lambda x: x['timestamp']['S'], reverse=True)
+        # Expenses come from the index query already sorted newest first
+        sorted_expenses = expenses
         
         # Apply limit if specified
         limit = time_range.get('limit')
@@ -379,14 +778,13 @@ def format_expense_summary(expenses, time_range, threshold=None):
                 
                 return "\n".join(response)
         
-        # Calculate total
-        total = sum(float(exp['amount']['N']) for exp in sorted_expenses)
-        
-        # Group by category
+        # Calculate total and group by category in one pass
+        total = 0.0
         categories = {}
         for exp in sorted_expenses:
             cat = exp['category']['S']
             amount = float(exp['amount']['N'])
+            total += amount
             categories[cat] = categories.get(cat, 0) + amount
         
         # Format summary
@@ -444,18 +842,45 @@ def send_telegram_reply(chat_id, message_id, text):
         "parse_mode": "HTML"  # **Ensures proper formatting in Telegram**
     }
 
-    logger.info(f"📤 Sending reply to Telegram: {json.dumps(payload)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📤 Sending reply to Telegram: %s", orjson.dumps(payload).decode())
 
     try:
-        response = requests.post(TELEGRAM_API_URL, json=payload)
+        # Drop the reply rather than sleep past the timeout; the message is already claimed either way
+        if not (_TELEGRAM_BUCKET.acquire(send_budget()) and chat_bucket(chat_id).acquire(send_budget())):
+            logger.error(f"⏳ Telegram rate limit would outlast the timeout, dropping reply to chat {chat_id}")
+            return
+        
+        response = _HTTP.post(TELEGRAM_API_URL, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT))
+        if response.status_code == 429:
+            # Flood control: wait as long as Telegram asks and try once more, if that fits in the timeout
+            retry_after = orjson.loads(response.content).get("parameters", {}).get("retry_after", 1)
+            if retry_after <= min(TELEGRAM_MAX_RETRY_AFTER, send_budget()):
+                logger.warning(f"⏳ Telegram rate limited, retrying after {retry_after}s")
+                time.sleep(retry_after)
+                response = _HTTP.post(TELEGRAM_API_URL, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT))
         response.raise_for_status()  # Raise an error for bad responses
         
-        logger.info(f"✅ Message sent successfully: {response.json()}")
+        logger.info("✅ Message sent successfully to chat %s", chat_id)
     except requests.exceptions.HTTPError as http_err:
         logger.error(f"⚠️ HTTP error occurred: {http_err} - Response: {response.text}")
     except Exception as e:
         logger.error(f"⚠️ Failed to send message: {str(e)}")
 
+def send_chat_action(chat_id, action="typing"):
+    """ Shows a chat action such as "typing..." while a slow reply is being prepared; best effort only """
+    try:
+        if not _TELEGRAM_BUCKET.acquire(0):
+            return  # Not worth queueing for
+        response = _HTTP.post(
+            TELEGRAM_CHAT_ACTION_URL,
+            json={"chat_id": chat_id, "action": action},
+            timeout=(HTTP_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+        )
+        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to send chat action: {str(e)}")
+
 # Your other functions (analyze_expense, parse_gemini_response, etc.) remain unchanged
 
 def is_expense_entry(text):
@@ -466,18 +891,13 @@ def is_expense_entry(text):
     logger.info(f"Checking if this is an expense entry: {text_lower}")
     
     # Check if the text contains any number - this is the most basic check
-    has_number = bool(re.search(r'\d+', text_lower))
+    has_number = bool(_NUM_RE.search(text_lower))
     if not has_number:
         logger.info(f"Not an expense entry - no numbers found: {text_lower}")
         return False
     
-    # Check for emojis that indicate expense categories
-    electronics_emojis = ["💻", "📱", "⌚", "🖥️", "🖨️", "📷", "🎮"]
-    food_emojis = ["🍕", "🍔", "🍟", "🍗", "🍖", "🥗", "🍣", "🍩", "🍦", "🍨", "🧁", "🍰", "🍪"]
-    transport_emojis = ["🚗", "🚕", "🚌", "🚆", "✈️", "🛵", "🚲", "🚅", "🚄"]
-    
-    # If text has a number and any relevant emoji, it's likely an expense
-    if has_number and any(emoji in text for emoji in electronics_emojis + food_emojis + transport_emojis):
+    # If text has a number and any emoji that indicates an expense category, it's likely an expense
+    if has_number and not _ALL_EMOJIS.isdisjoint(text):
         logger.info(f"Detected expense entry with emoji: {text}")
         return True
     
@@ -492,7 +912,8 @@ def format_inr(amount):
         if isinstance(amount, str):
             amount = float(amount.replace(',', ''))
         num = float(amount)
-        return "{:,.2f}".format(num).rstrip('0').rstrip('.') if '.' in str(amount) else "{:,.0f}".format(num)
+        # Whole amounts need no decimals; others keep up to two, without trailing zeros
+        return f"{num:,.0f}" if num.is_integer() else f"{num:,.2f}".rstrip('0').rstrip('.')
     except Exception as e:
         logger.error(f"Error formatting amount: {str(e)}")
         return "???"
@@ -505,84 +926,70 @@ def extract_inr_amount(text):
     logger.info(f"Extracting amount from: {text}")
 
     # Regex to match amounts with optional decimal and multipliers
-    match = re.search(r'(\d+(\.\d+)?)\s*(k|thousand|l|lakh|lakhs|cr|crore|crores)?', text, re.IGNORECASE)
+    match = _AMOUNT_RE.search(text)
     
     if match:
-        try:
-            amount = float(match.group(1))  # Extract numeric part
-            multiplier = match.group(3)  # Extract multiplier, if any
-
-            # Apply multipliers if present
-            if multiplier:
-                multiplier = multiplier.lower()
-                if multiplier in ('k', 'thousand'):
-                    amount *= 1_000
-                elif multiplier in ('l', 'lakh', 'lakhs'):
-                    amount *= 100_000
-                elif multiplier in ('cr', 'crore', 'crores'):
-                    amount *= 10_000_000
-
-                logger.info(f"Applied '{multiplier}' multiplier: {amount}")
-
-            logger.info(f"Extracted amount: {amount}")
-            return amount
-        except Exception as e:
-            logger.error(f"🔥 Error converting amount: {str(e)}")
+        amount = float(match.group(1))  # Extract numeric part
+        multiplier = match.group(2)  # Extract multiplier, if any
+        
+        # Apply multipliers if present
+        if multiplier:
+            amount *= _AMOUNT_MULTIPLIERS[multiplier]
+            logger.info(f"Applied '{multiplier}' multiplier: {amount}")
+        
+        logger.info(f"Extracted amount: {amount}")
+        return amount
 
     logger.warning(f"⚠️ No amount found in text: {text}")
     return None
 
  
 
+def fast_classify(prompt):
+    """ Classify short, unambiguous messages like "coffee 200" locally; None means ask Gemini """
+    tokens = [token.strip(".,!?") for token in prompt.lower().split()]
+    if len(tokens) > FAST_PATH_MAX_TOKENS:
+        return None
+    
+    # Exactly one number, no detached multiplier ("5 k"), no keyword the Gemini prompt files
+    # elsewhere, and every category keyword among the words agrees
+    numbers = [token for token in tokens if any(char.isdecimal() for char in token)]
+    if len(numbers) != 1 or not _MULTIPLIER_WORDS.isdisjoint(tokens) or not _FAST_PATH_CONFLICTS.isdisjoint(tokens):
+        return None
+    categories = {_CATEGORY_NAMES[_KEYWORD_RANK[token]] for token in tokens if token in _KEYWORD_RANK}
+    if len(categories) != 1:
+        return None
+    
+    # Read the amount from the number itself, so a following word like "lunch" isn't taken for lakh
+    amount = extract_inr_amount(numbers[0])
+    if not amount or amount <= 0:
+        return None
+    
+    category = categories.pop()
+    return {
+        'amount': format_inr(amount),
+        'category': category,
+        'message': generate_fallback_message(category)
+    }
+
+
 def analyze_expense(prompt):
     """Calls Gemini API to analyze expense details with better error handling"""
     # Log the prompt for debugging
     logger.info(f"Analyzing expense prompt: {prompt}")
     
-    system_prompt = """You are a smart expense tracking assistant for Indian users. Analyze the user's expense message and:
-
-1. Extract numerical amount in any format (₹500, 5k, 1.5L, 4L, 1Cr etc.) - where k=thousand, L = Lakh (100,000) and Cr = Crore (10,000,000)
-2. Determine the most appropriate category from this list:
-   - Food (meals, restaurants, snacks, groceries, dining, coffee, tea, beverages)
-   - Groceries (supermarket, fruits, vegetables, household items)
-   - Transport (uber, ola, taxi, auto, bus, metro, fuel, travel)
-   - Vehicle (car, bike, cycle, repair, servicing, automotive, motor)
-   - Bills (electricity, water, internet, recharges, subscriptions)
-   - Health (medicines, doctor visits, hospital, medical)
-   - Fashion (clothes, shoes, frocks, dresses, accessories, footwear)
-   - Electronics (gadgets, phones, iphone, smartphone, laptop, computer, devices)
-   - Personal Care (haircut, spa, cosmetics, grooming)
-   - Education (books, courses, tuition, coaching)
-   - Entertainment (movies, games, events, recreation)
-   - Shopping (general purchases)
-   - Home (furniture, decor, appliances, housing)
-   - Miscellaneous (anything else)
-3. Generate a friendly response message in English (20-30 words) with emojis.
-4. Return JSON format: {"amount": number, "category": string, "message": string}
-
-IMPORTANT: Be extremely flexible in understanding expense formats. Extract any number and make a reasonable guess at the category.
-Always return a valid numerical amount and category even if you have to guess based on limited information.
-"""
-
-    payload = {
-        "contents": [{
-            "parts": [{"text": f"{system_prompt}\n\nUser Input: {prompt}"}]
-        }]
-    }
-
+    fast_result = fast_classify(prompt)
+    if fast_result:
+        logger.info(f"⚡ Classified locally, skipping Gemini: {fast_result}")
+        return fast_result
+    
     try:
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            json=payload,
-            timeout=10
+        response_text = gemini_generate_cached(
+            f"{_EXPENSE_SYSTEM_PROMPT}\n\nUser Input: {prompt}",
+            (HTTP_CONNECT_TIMEOUT, 10),
+            ("expense", normalize_prompt(prompt))
         )
         
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        response_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-        
         # Log the response from Gemini for debugging
         logger.info(f"Gemini response: {response_text}")
         
@@ -615,12 +1022,10 @@ Always return a valid numerical amount and category even if you have to guess ba
 def parse_gemini_response(response_text, original_prompt):
     """ Parses the response from Gemini API and ensures proper formatting """
     try:
-        json_str = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if not json_str:
+        data = _extract_first_json(response_text)
+        if data is None:
             logger.error(f"No JSON found in response: {response_text}")
             return fallback_analysis(original_prompt)
-            
-        data = json.loads(json_str.group())
         
         # Validate the data
         if 'amount' not in data or 'category' not in data:
@@ -648,144 +1053,65 @@ def fallback_analysis(prompt):
     # Log that we're using fallback
     logger.info(f"Using fallback analysis for: {prompt}")
     
-    # Try to extract amount and category from the text
-    amount = extract_inr_amount(prompt)
-    
-    # Determine category with better handling of electronics
-    category = determine_fallback_category(prompt)
+    amount, category = fallback_amount_and_category(prompt)
     
+    # A fresh dict each call, since callers adjust the result in place
     return {
         'amount': format_inr(amount) if amount else "???",
         'category': category,
         'message': generate_fallback_message(category)
     }
 
+@lru_cache(maxsize=FALLBACK_CACHE_SIZE)
+def fallback_amount_and_category(prompt):
+    """ Extract the amount and category locally; memoized, as one prompt can fall back several times """
+    # Try to extract amount and category from the text
+    amount = extract_inr_amount(prompt)
+    
+    # Determine category with better handling of electronics
+    category = determine_fallback_category(prompt)
+    
+    return amount, category
+
 def determine_fallback_category(text):
     """Improved category determination including emoji support"""
     text_lower = text.lower()
     
-    # Electronics emojis
-    electronics_emojis = ["💻", "📱", "⌚", "🖥️", "🖨️", "📷", "🎮"]
-    if any(emoji in text for emoji in electronics_emojis):
-        return 'Electronics'
-    
-    # Food emojis
-    food_emojis = ["🍕", "🍔", "🍟", "🍗", "🍖", "🥗", "🍣", "🍩", "🍦", "🍨", "🧁", "🍰", "🍪"]
-    if any(emoji in text for emoji in food_emojis):
-        return 'Food'
-    
-    # Transport emojis
-    transport_emojis = ["🚗", "🚕", "🚌", "🚆", "✈️", "🛵", "🚲", "🚅", "🚄"]
-    if any(emoji in text for emoji in transport_emojis):
+    # Emoji checks, in priority order, against the emojis found in one pass over the text
+    emojis = _ALL_EMOJIS.intersection(text)
+    if emojis:
+        if not emojis.isdisjoint(_ELECTRONICS_EMOJIS):
+            return 'Electronics'
+        if not emojis.isdisjoint(_FOOD_EMOJIS):
+            return 'Food'
         return 'Transport'
     
-    # Regular keyword checks
-    category_keywords = {
-        'Food': ['food', 'meal', 'lunch', 'dinner', 'breakfast', 'restaurant', 'eat', 'coffee', 'tea', 'cafe'],
-        'Groceries': ['grocery', 'groceries', 'supermarket', 'fruit', 'vegetable'],
-        'Transport': ['uber', 'ola', 'taxi', 'auto', 'transport', 'travel', 'bus', 'train', 'metro'],
-        'Vehicle': ['car', 'bike', 'cycle', 'repair', 'service', 'motor', 'fuel', 'petrol', 'diesel'],
-        'Bills': ['bill', 'recharge', 'subscription', 'electricity', 'water', 'internet', 'phone bill'],
-        'Health': ['medicine', 'doctor', 'hospital', 'medical', 'health', 'clinic', 'dentist'],
-        'Fashion': ['clothes', 'dress', 'shirt', 'pant', 'shoe', 'footwear', 'apparel', 'fashion'],
-        'Electronics': ['phone', 'mobile', 'laptop', 'computer', 'gadget', 'electronics', 'device'],
-        'Entertainment': ['movie', 'game', 'show', 'concert', 'entertainment', 'theatre', 'amusement'],
-        'Education': ['book', 'course', 'class', 'tuition', 'school', 'college', 'education']
-    }
-    
-    for category, keywords in category_keywords.items():
-        if any(keyword in text_lower for keyword in keywords):
-            return category
+    # Regular keyword checks: the earliest category with a keyword anywhere in the text wins
+    best = None
+    for match in _CATEGORY_RE.finditer(text_lower):
+        rank = _KEYWORD_RANK[match.group(1)]
+        if best is None or rank < best:
+            best = rank
+            if rank == 0:
+                break
+    if best is not None:
+        return _CATEGORY_NAMES[best]
     
     # Default
     return 'Miscellaneous'
 
 def generate_fallback_message(category):
     """Generate a friendly message based on category"""
-    messages = {
-        'Electronics': "New gadget! 📱 Your electronics purchase has been logged. Enjoy your new device!",
-        'Bills': "Payment noted! 🧾 I've recorded your bill payment. Keeping your expenses organized!",
-        'Food': "Yum! 🍔 I've added your food expense to your tracker. Bon appétit!",
-        'Transport': "On the move! 🚗 I've logged your transport expense. Safe travels!",
-        'Miscellaneous': "Got it! 💰 Your expense has been recorded. Thanks for keeping track!"
-    }
-    
-    return messages.get(category, "Added to expenses! 💰")
-
-def is_deletion_request(text):
-    """Check if text is asking to delete expense history"""
-    text_lower = text.lower()
-    
-    # Keywords that indicate deletion
-    deletion_keywords = [
-        "delete", "remove", "erase", "clear", "clean", "wipe", "purge"
-    ]
-    
-    # Target phrases
-    target_phrases = [
-        "expense", "expenses", "history", "data", "records", "transactions"
-    ]
-    
-    has_deletion_keyword = any(keyword in text_lower for keyword in deletion_keywords)
-    has_target_phrase = any(phrase in text_lower for phrase in target_phrases)
-    
-    if has_deletion_keyword and has_target_phrase:
-        logger.info(f"Detected as deletion request: {text_lower}")
-        return True
-    
-    logger.info(f"Not detected as deletion request: {text_lower}")
-    return False
-
+    return _FALLBACK_MESSAGES.get(category, "Added to expenses! 💰")
 
 def extract_deletion_time_range(text):
     """Extract time range or count for deletion using Gemini API"""
-    system_prompt = """You are an expense tracking assistant. Analyze the user's request to delete their expense history and extract either a time range or a count of recent expenses.
-    
-    Return a JSON with the following format:
-    {
-        "days": number or null,
-        "description": "human readable description of what to delete",
-        "count": number or null,
-        "position": string or null (possible values: "first", "last", or null)
-    }
-    
-    Examples:
-    - "delete all my expenses" → {"days": null, "description": "all expenses", "count": null, "position": null}
-    - "erase my expenses from last week" → {"days": 7, "description": "last week", "count": null, "position": null}
-    - "clear my expense history for this month" → {"days": 30, "description": "this month", "count": null, "position": null}
-    - "remove my expenses from last 3 days" → {"days": 3, "description": "last 3 days", "count": null, "position": null}
-    - "delete my last 2 expenses" → {"days": null, "description": "last 2 expenses", "count": 2, "position": "last"}
-    - "delete first 2 expenses" → {"days": null, "description": "first 2 expenses", "count": 2, "position": "first"}
-    - "delete my recent 5 expenses" → {"days": null, "description": "last 5 expenses", "count": 5, "position": "last"}
-    
-    IMPORTANT: Pay careful attention to words like "first" or "last" when deleting a specific number of expenses.
-    - "first N expenses" means the oldest N expenses (top of the list)
-    - "last N expenses" means the most recent N expenses (shown first in the list)
-    - If no position is specified, assume "last" (most recent)
-    """
-
-    payload = {
-        "contents": [{
-            "parts": [{"text": f"{system_prompt}\n\nUser request: {text}"}]
-        }]
-    }
-
     try:
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            json=payload,
-            timeout=8
-        )
-        
-        response.raise_for_status()
-        result = response.json()
-        
-        response_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+        response_text = gemini_generate(f"{_DELETION_SYSTEM_PROMPT}\n\nUser request: {text}", (HTTP_CONNECT_TIMEOUT, 8))
         
         # Extract JSON from response
-        json_match = re.search(r'(\{.*\})', response_text, re.DOTALL)
-        if json_match:
-            time_range = json.loads(json_match.group(1))
+        time_range = _extract_first_json(response_text)
+        if time_range is not None:
             return {
                 "days": time_range.get("days"),
                 "description": time_range.get("description", "specified expenses"),
@@ -802,23 +1128,27 @@ def extract_deletion_time_range(text):
 def handle_deletion_request(chat_id, message_id, username, time_range):
     """Handle a request to delete expenses"""
     try:
+        start_time = None
+        end_time = utc_now().isoformat()  # Expenses logged after the request are never part of it
+        expense_ids = None  # Only count-based deletions need their exact IDs kept for the confirmation
+        
         # Get expenses based on time range or count
         if time_range.get("count") is not None:
             # Get all expenses for the user
-            all_expenses = get_all_user_expenses(username)
+            all_expenses = get_all_user_expenses(username, end_time)
             
-            # Sort expenses by timestamp based on position
+            # Pick expenses by position; the index query already returns them newest first
             position = time_range.get("position", "last")  # Default to "last" if not specified
+            count = min(time_range["count"], len(all_expenses), DELETION_MAX_COUNT)
             
             if position == "last":
                 # Most recent expenses first (newest first)
-                sorted_expenses = sorted(all_expenses, key=lambda x: x['timestamp']['S'], reverse=True)
+                expenses = all_expenses[:count]
             else:  # "first" position
                 # Oldest expenses first
-                sorted_expenses = sorted(all_expenses, key=lambda x: x['timestamp']['S'], reverse=False)
+                expenses = all_expenses[len(all_expenses) - count:][::-1]
             
-            count = min(time_range["count"], len(sorted_expenses))
-            expenses = sorted_expenses[:count]
+            expense_ids = [exp["message_id"]["S"] for exp in expenses]
             
             # Log what we're deleting
             logger.info(f"Deleting {count} expenses from position {position}")
@@ -826,10 +1156,10 @@ def handle_deletion_request(chat_id, message_id, username, time_range):
                 logger.info(f"Will delete: {exp.get('description', {}).get('S')} - {exp.get('amount', {}).get('N')}")
                 
         elif time_range.get("days") is not None:
-            start_time = (datetime.utcnow() - timedelta(days=time_range["days"])).isoformat()
-            expenses = get_user_expenses_for_deletion(username, start_time)
+            start_time = (utc_now() - timedelta(days=time_range["days"])).isoformat()
+            expenses = get_user_expenses_for_deletion(username, start_time, end_time)
         else:
-            expenses = get_all_user_expenses(username)
+            expenses = get_all_user_expenses(username, end_time)
         
         expense_count = len(expenses)
         
@@ -841,14 +1171,15 @@ def handle_deletion_request(chat_id, message_id, username, time_range):
         confirmation_code = str(uuid.uuid4())[:8]
         
         # Store the deletion request with an expiration
-        deletion_confirmations[username] = {
+        save_deletion_confirmation(username, {
             "confirmation_code": confirmation_code,
             "time_range": time_range,
-            "expenses_to_delete": [exp["message_id"]["S"] for exp in expenses],  # Store IDs of expenses to delete
+            "expenses_to_delete": expense_ids,  # None for time-range and delete-all requests, which re-run their query
             "chat_id": chat_id,
             "expense_count": expense_count,
-            "expires_at": time.time() + 300  # 5 minutes expiration
-        }
+            "start_time": start_time,  # Reused on confirmation rather than recomputed
+            "end_time": end_time  # Bounds the confirmation's re-query to what the user was shown
+        })
         
         # Calculate total amount
         total_amount = sum(float(exp['amount']['N']) for exp in expenses)
@@ -872,30 +1203,71 @@ To cancel, simply ignore this message or type "cancel".
         send_telegram_reply(chat_id, message_id, "I encountered an error processing your deletion request. Please try again.")
 
 
-def is_deletion_confirmation(username, text):
-    """Check if this is a confirmation for deletion"""
-    # First check if there's a pending confirmation for this user
-    if username not in deletion_confirmations:
-        return False
+def is_confirmation_reply(text_lower):
+    """Check if a lowercased message looks like a "confirm <code>" or "cancel" reply"""
+    if text_lower == "cancel":
+        return True
+    # Cheap prefix check first; almost no message starts with "confirm"
+    return text_lower.startswith("confirm") and _CONFIRM_RE.match(text_lower) is not None
+
+
+def save_deletion_confirmation(username, confirmation_data):
+    """Store a pending deletion confirmation in DynamoDB, expiring via the table's TTL"""
+    expires_at = int(time.time()) + DELETION_CONFIRMATION_TTL
+    _ddb().put_item(
+        TableName=DYNAMODB_TABLE,
+        Item={
+            "message_id": {"S": f"CONF#{username}"},
+            "type": {"S": "DELETION_CONFIRMATION"},
+            "data": {"S": orjson.dumps(confirmation_data).decode()},
+            "expires_at": {"N": str(expires_at)}  # The table's TTL attribute (epoch seconds)
+        }
+    )
+
+
+def get_deletion_confirmation(username):
+    """Fetch the user's pending deletion confirmation, or None if there is none or it expired"""
+    try:
+        response = _ddb().get_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"message_id": {"S": f"CONF#{username}"}},
+            ConsistentRead=True
+        )
+    except Exception as e:
+        logger.error(f"⚠️ Error getting deletion confirmation: {str(e)}")
+        return None
     
-    # Check if the confirmation has expired
-    if deletion_confirmations[username]["expires_at"] < time.time():
-        # Remove expired confirmation
-        del deletion_confirmations[username]
-        return False
+    item = response.get("Item")
     
-    # Check if this is a confirmation or cancellation
-    text_lower = text.lower()
+    # TTL deletion is lazy, so an expired item can still be returned
+    if not item or int(item["expires_at"]["N"]) < time.time():
+        return None
+    
+    return orjson.loads(item["data"]["S"])
+
+
+def clear_deletion_confirmation(username):
+    """Remove the user's pending deletion confirmation"""
+    try:
+        _ddb().delete_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"message_id": {"S": f"CONF#{username}"}}
+        )
+    except Exception as e:
+        logger.error(f"⚠️ Error clearing deletion confirmation: {str(e)}")
+
+
+def is_deletion_confirmation(confirmation_data, text_lower):
+    """Check if this is a confirmation for the user's pending deletion (None if there is none)"""
+    if confirmation_data is None:
+        return False
     
     # Check for cancellation
     if text_lower == "cancel":
-        # Remove the confirmation
-        del deletion_confirmations[username]
         return True
     
     # Check for confirmation with code
-    confirmation_data = deletion_confirmations[username]
-    confirmation_match = re.match(r'confirm\s+(\w+)', text_lower)
+    confirmation_match = _CONFIRM_RE.match(text_lower)
     
     if confirmation_match and confirmation_match.group(1) == confirmation_data["confirmation_code"]:
         return True
@@ -903,38 +1275,30 @@ def is_deletion_confirmation(username, text):
     return False
 
 
-def handle_deletion_confirmation(chat_id, message_id, username, text):
-    """Handle the confirmation response for deletion"""
-    if username not in deletion_confirmations:
-        send_telegram_reply(chat_id, message_id, "I don't have any pending deletion requests for you.")
-        return
-    
-    text_lower = text.lower()
-    
+def handle_deletion_confirmation(chat_id, message_id, username, confirmation_data, text_lower):
+    """Handle the confirmation response for the user's pending deletion"""
     # Check if this is a cancellation
     if text_lower == "cancel":
-        del deletion_confirmations[username]
+        clear_deletion_confirmation(username)
         send_telegram_reply(chat_id, message_id, "Expense deletion cancelled. Your data remains intact.")
         return
     
     # Execute the deletion
-    confirmation_data = deletion_confirmations[username]
     time_range = confirmation_data["time_range"]
     expense_count = confirmation_data["expense_count"]
     
     try:
         # Use the stored expense IDs if available
-        if "expenses_to_delete" in confirmation_data:
+        if confirmation_data.get("expenses_to_delete") is not None:
             expense_ids = confirmation_data["expenses_to_delete"]
             deleted_count = delete_specific_expenses(expense_ids)
         elif time_range.get("days") is not None:
-            start_time = (datetime.utcnow() - timedelta(days=time_range["days"])).isoformat()
-            deleted_count = delete_user_expenses(username, start_time)
+            deleted_count = delete_user_expenses(username, confirmation_data["start_time"], confirmation_data["end_time"])
         else:
-            deleted_count = delete_all_user_expenses(username)
+            deleted_count = delete_all_user_expenses(username, confirmation_data["end_time"])
         
         # Remove the confirmation data
-        del deletion_confirmations[username]
+        clear_deletion_confirmation(username)
         
         # Send success message
         send_telegram_reply(
@@ -947,92 +1311,46 @@ def handle_deletion_confirmation(chat_id, message_id, username, text):
         send_telegram_reply(chat_id, message_id, "I encountered an error while deleting your expenses. Please try again.")
 
 
-def get_user_expenses_for_deletion(username, start_time):
+def get_user_expenses_for_deletion(username, start_time, end_time):
     """Get user expenses for a specific time range for deletion"""
     try:
-        response = dynamodb.scan(
-            TableName=DYNAMODB_TABLE,
-            FilterExpression="username = :u AND #type = :t AND #ts >= :st",
-            ExpressionAttributeNames={
-                "#type": "type",
-                "#ts": "timestamp"
-            },
-            ExpressionAttributeValues={
-                ":u": {"S": username},
-                ":t": {"S": "EXPENSE"},
-                ":st": {"S": start_time}
-            }
-        )
-        
-        return response.get('Items', [])
+        return query_user_expenses(username, start_time, attributes=DELETION_ATTRIBUTES, end_time=end_time)
     except Exception as e:
         logger.error(f"⚠️ Error getting expenses for deletion: {str(e)}")
         return []
 
 
-def get_all_user_expenses(username):
-    """Get all expenses for a user"""
+def get_all_user_expenses(username, end_time):
+    """Get all expenses for a user logged up to end_time"""
     try:
-        response = dynamodb.scan(
-            TableName=DYNAMODB_TABLE,
-            FilterExpression="username = :u AND #type = :t",
-            ExpressionAttributeNames={
-                "#type": "type"
-            },
-            ExpressionAttributeValues={
-                ":u": {"S": username},
-                ":t": {"S": "EXPENSE"}
-            }
-        )
-        
-        return response.get('Items', [])
+        return query_user_expenses(username, attributes=DELETION_ATTRIBUTES, end_time=end_time)
     except Exception as e:
         logger.error(f"⚠️ Error getting all user expenses: {str(e)}")
         return []
 
 
-def delete_user_expenses(username, start_time):
+def delete_user_expenses(username, start_time, end_time):
     """Delete user expenses from a specific time range"""
     try:
         # Get expenses to delete
-        expenses = get_user_expenses_for_deletion(username, start_time)
+        expenses = get_user_expenses_for_deletion(username, start_time, end_time)
         
-        deleted_count = 0
-        for expense in expenses:
-            # Get the message_id for deletion
-            message_id = expense["message_id"]["S"]
-            
-            # Delete the item
-            dynamodb.delete_item(
-                TableName=DYNAMODB_TABLE,
-                Key={"message_id": {"S": message_id}}
-            )
-            deleted_count += 1
+        deleted_count = batch_delete_expenses([expense["message_id"]["S"] for expense in expenses])
         
-        logger.info(f"Deleted {deleted_count} expenses for user {username} from {start_time}")
+        logger.info(f"Deleted {deleted_count} expenses for user {username} from {start_time} to {end_time}")
         return deleted_count
     except Exception as e:
         logger.error(f"⚠️ Error deleting expenses: {str(e)}")
         raise e
 
 
-def delete_all_user_expenses(username):
-    """Delete all expenses for a user"""
+def delete_all_user_expenses(username, end_time):
+    """Delete all expenses a user logged up to end_time"""
     try:
         # Get all expenses
-        expenses = get_all_user_expenses(username)
+        expenses = get_all_user_expenses(username, end_time)
         
-        deleted_count = 0
-        for expense in expenses:
-            # Get the message_id for deletion
-            message_id = expense["message_id"]["S"]
-            
-            # Delete the item
-            dynamodb.delete_item(
-                TableName=DYNAMODB_TABLE,
-                Key={"message_id": {"S": message_id}}
-            )
-            deleted_count += 1
+        deleted_count = batch_delete_expenses([expense["message_id"]["S"] for expense in expenses])
         
         logger.info(f"Deleted all {deleted_count} expenses for user {username}")
         return deleted_count
@@ -1043,16 +1361,65 @@ def delete_all_user_expenses(username):
 def delete_specific_expenses(expense_ids):
     """Delete specific expenses by their message_id"""
     try:
-        deleted_count = 0
-        for message_id in expense_ids:
-            dynamodb.delete_item(
-                TableName=DYNAMODB_TABLE,
-                Key={"message_id": {"S": message_id}}
-            )
-            deleted_count += 1
+        deleted_count = batch_delete_expenses(expense_ids)
         
         logger.info(f"Deleted {deleted_count} specific expenses")
         return deleted_count
     except Exception as e:
         logger.error(f"⚠️ Error deleting specific expenses: {str(e)}")
-        raise e
\ No newline at end of file
+        raise e
+
+
+def batch_delete_expenses(expense_ids):
+    """Delete items by message_id with BatchWriteItem, 25 keys per request, sending the requests concurrently"""
+    chunks = [expense_ids[start:start + BATCH_WRITE_SIZE] for start in range(0, len(expense_ids), BATCH_WRITE_SIZE)]
+    if len(chunks) == 1:
+        batch_delete_chunk(chunks[0])
+    else:
+        # Overlap the round trips; map re-raises the first failure
+        list(_EXECUTOR.map(batch_delete_chunk, chunks))
+    
+    return len(expense_ids)
+
+
+def batch_delete_chunk(expense_ids):
+    """Send one BatchWriteItem of deletes, retrying unprocessed items with exponential backoff"""
+    request_items = {
+        DYNAMODB_TABLE: [
+            {"DeleteRequest": {"Key": {"message_id": {"S": message_id}}}}
+            for message_id in expense_ids
+        ]
+    }
+    
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        response = _ddb().batch_write_item(RequestItems=request_items)
+        request_items = response.get("UnprocessedItems")
+        if not request_items:
+            return
+        time.sleep(0.05 * 2 ** attempt)  # Exponential backoff before retrying throttled deletes
+    
+    raise RuntimeError(f"{len(request_items[DYNAMODB_TABLE])} expenses were still unprocessed after retries")
+
+
+def batch_get_expenses(expense_ids):
+    """Fetch items by message_id with BatchGetItem, 100 keys per request, keeping the order of expense_ids"""
+    found = {}
+    for start in range(0, len(expense_ids), BATCH_GET_SIZE):
+        request_items = {
+            DYNAMODB_TABLE: {
+                "Keys": [{"message_id": {"S": message_id}} for message_id in expense_ids[start:start + BATCH_GET_SIZE]]
+            }
+        }
+        
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            response = _ddb().batch_get_item(RequestItems=request_items)
+            for item in response.get("Responses", {}).get(DYNAMODB_TABLE, []):
+                found[item["message_id"]["S"]] = item
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                break
+            time.sleep(0.05 * 2 ** attempt)  # Exponential backoff before retrying throttled reads
+        else:
+            raise RuntimeError(f"{len(request_items[DYNAMODB_TABLE]['Keys'])} expenses were still unprocessed after retries")
+    
+    return [found[message_id] for message_id in expense_ids if message_id in found]
\ No newline at end of file
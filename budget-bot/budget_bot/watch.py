@@ -1,56 +1,258 @@
-import time
+import errno
+import hashlib
+import logging
+import os
+import queue
+import re
 import subprocess
 import signal
+import threading
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.observers.polling import PollingObserver
+from watchdog.events import PatternMatchingEventHandler
 
-# Global variable to store the running SAM process
-sam_process = None
+logger = logging.getLogger(__name__)
 
-EXCLUDED_DIRS = [".aws-sam"]  # Ignore .aws-sam directory
+# Only one `sam build` at a time; changes arriving mid-build trigger exactly one follow-up
+_build_lock = threading.Lock()
+_pending = False
 
-class FileChangeHandler(FileSystemEventHandler):
-    def on_any_event(self, event):
-        if any(excluded in event.src_path for excluded in EXCLUDED_DIRS):
-            return  # Ignore changes in .aws-sam
-        
-        if event.src_path.endswith((".py")) and event.event_type in ["modified", "created"]:
-            print(f"🔄 File changed: {event.src_path}. Rebuilding and restarting...")
-            restart_sam()
+EXCLUDED_DIRS = frozenset([".aws-sam", ".git", "__pycache__", "node_modules", ".venv"])  # Build output, VCS, bytecode and deps
+EDITOR_TEMP_PATTERNS = ["*/.#*"]  # Emacs lock files (.#app.py), the only editor temp files that also match *.py
+WATCH_PATTERNS = ["*.py"]
+
+# One C-level search for any excluded path component, at any depth
+_EXCLUDE_RE = re.compile(r"(?:^|[\\/])(?:%s)(?:[\\/]|$)" % "|".join(re.escape(d) for d in sorted(EXCLUDED_DIRS)))
+# Absolute and canonical excluded roots, matched with a single tuple startswith()
+_EXCLUDED_PREFIXES = tuple(sorted({
+    normalize(d) + os.sep for d in EXCLUDED_DIRS for normalize in (os.path.abspath, os.path.realpath)
+}))
+
+DEBOUNCE_SECONDS = 0.5  # Quiet period after the last change before rebuilding
+SAM_STOP_TIMEOUT = 5  # Seconds to wait for SIGTERM before escalating to SIGKILL
+POLLING_INTERVAL = 2  # Seconds between scans when falling back to PollingObserver
+TEMPLATE_FILE = "template.yaml"  # SAM template whose CodeUri dirs are the only ones that trigger rebuilds
+
+_CODE_URI_RE = re.compile(r"^\s*CodeUri:\s*[\"']?([^\"'\s#]+)", re.MULTILINE)
+
+def code_uri_prefixes(template=TEMPLATE_FILE):
+    """ Collect the CodeUri directories declared in the SAM template; empty means watch everything """
+    try:
+        with open(template) as f:
+            content = f.read()
+    except OSError:
+        return ()
+    base = os.path.dirname(template)
+    return tuple(os.path.realpath(os.path.join(base, uri)) + os.sep for uri in _CODE_URI_RE.findall(content))
+
+class FileChangeHandler(PatternMatchingEventHandler):
+    def __init__(self):
+        super().__init__(
+            patterns=WATCH_PATTERNS,
+            ignore_patterns=EDITOR_TEMP_PATTERNS,
+            ignore_directories=True,
+            case_sensitive=True,
+        )
+        self._timer = None
+        self._lock = threading.Lock()
+        self._hashes = {}  # path -> content digest of the last version that triggered a build
+        self._code_uris = code_uri_prefixes()
+        self._events = queue.Queue()
+        threading.Thread(target=self._drain_events, daemon=True).start()
+
+    # Only the two event types we act on are overridden, so watchdog's dispatch
+    # skips deleted/moved/opened/closed events without any string comparison here
+    def on_modified(self, event):
+        self._events.put(event.src_path)  # Filtered in batches by _drain_events
+
+    on_created = on_modified
+
+    def _drain_events(self):
+        """ Handle queued events in batches, so a burst costs one filtering pass per unique path """
+        while True:
+            batch = {self._events.get()}
+            while True:
+                try:
+                    batch.add(self._events.get_nowait())
+                except queue.Empty:
+                    break
+
+            changed = [path for path in sorted(batch) if self._should_rebuild(path)]
+            if changed:
+                logger.info("🔄 File changed: %s. Rebuilding and restarting...", ", ".join(changed))
+                self._schedule_restart()
+
+    def _should_rebuild(self, path):
+        """ Decide whether a changed path affects the Lambda bundle """
+        if _EXCLUDE_RE.search(path):
+            return False  # Build output and bytecode
+        if os.path.abspath(path).startswith(_EXCLUDED_PREFIXES):
+            return False  # Absolute event paths, checked without touching the filesystem
+        real_path = os.path.realpath(path)
+        if real_path.startswith(_EXCLUDED_PREFIXES):
+            return False  # Symlinks into the build output
+        if self._code_uris and not real_path.startswith(self._code_uris):
+            return False  # Tests, docs and tooling aren't packaged into the build artifact
+        # Skip files rewritten with identical bytes (format-on-save, focus-lost saves)
+        return self._content_changed(path)
+
+    def _content_changed(self, path):
+        """ Compare the file's content hash with the one seen last time """
+        try:
+            with open(path, "rb") as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).digest()
+        except OSError:
+            return False  # File vanished mid-save; the final rename will fire its own event
+        if self._hashes.get(path) == digest:
+            return False
+        self._hashes[path] = digest
+        return True
+
+    def _schedule_restart(self):
+        """ Coalesce a burst of save events into a single rebuild """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(DEBOUNCE_SECONDS, restart_sam)
+            self._timer.daemon = True
+            self._timer.start()
+
+class SamController:
+    """ Owns the SAM process so restarts from watcher threads and shutdown from the main thread can't race """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self._exited = threading.Event()  # Set by the SIGCHLD handler once the process is reaped
+        self._reaper_installed = False
+
+    def install_reaper(self):
+        """ Reap the SAM process from SIGCHLD instead of blocking in wait(); POSIX only, main thread only """
+        if hasattr(signal, "SIGCHLD"):
+            signal.signal(signal.SIGCHLD, lambda *_: self._reap())
+            self._reaper_installed = True
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def restart(self):
+        with self._lock:
+            self._stop()  # Stop previous instance
+            logger.info("👀 Watching for file changes (excluding .aws-sam)...")
+            logger.info("⚙️ Rebuilding SAM...")
+            # Watches stay in place during the build: .aws-sam is never watched, and
+            # source edits saved mid-build must still queue a follow-up build
+            subprocess.run(["sam", "build", "--cached", "--parallel"], check=False)  # Only rebuild changed functions
+
+            # logger.info("🚀 Starting SAM local API...")
+            # self._start()
+
+    def _start(self):
+        self._exited.clear()
+        self._proc = subprocess.Popen(["sam", "local", "start-api"], start_new_session=True)
+
+    def _stop(self):
+        """ Stop the running SAM process, escalating to SIGKILL if it doesn't exit in time """
+        if self._proc and self._proc.poll() is None:
+            self._signal(signal.SIGTERM)
+            try:
+                self._wait(timeout=SAM_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logger.warning("⚠️ SAM didn't stop in time, killing it...")
+                self._signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+                self._wait()
+        self._proc = None
+
+    def _wait(self, timeout=None):
+        """ Wait for the reaper to confirm exit, or fall back to a blocking wait() without one """
+        if not self._reaper_installed:
+            self._proc.wait(timeout=timeout)
+        elif not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self._proc.args, timeout)
+
+    def _reap(self):
+        # Runs inside the signal handler, so it must not take self._lock. poll() only
+        # reaps our own pid; waitpid(-1) would also steal the `sam build` child's status
+        proc = self._proc
+        if proc and proc.poll() is not None:
+            self._exited.set()
+
+    def _signal(self, sig):
+        """ Signal the whole SAM process group on POSIX, or just the process elsewhere """
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(self._proc.pid, sig)
+            else:
+                self._proc.send_signal(sig)
+        except ProcessLookupError:
+            pass  # Already gone
+
+controller = SamController()
 
 def restart_sam():
-    global sam_process
-    if sam_process:
-        sam_process.terminate()  # Stop previous instance
-        sam_process.wait()  # Ensure it's fully stopped
-    print("👀 Watching for file changes (excluding .aws-sam)...")
-    print("⚙️ Rebuilding SAM...")
-    subprocess.run(["sam", "build"])
+    global _pending
+    _pending = True
+    while _pending:
+        if not _build_lock.acquire(blocking=False):
+            return  # The running build will pick up the pending change
+        try:
+            while _pending:
+                _pending = False
+                controller.restart()
+        finally:
+            _build_lock.release()
+
+def schedule_watches(observer, event_handler, path="."):
+    """ Watch path's own files plus each non-excluded, non-hidden child dir recursively; one emitter per watch """
+    observer.schedule(event_handler, path, recursive=False)  # Top-level files only
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.name not in EXCLUDED_DIRS and not entry.name.startswith("."):
+                observer.schedule(event_handler, entry.path, recursive=True)
 
-    # print("🚀 Starting SAM local API...")
-    # sam_process = subprocess.Popen(["sam", "local", "start-api"])
+def start_observer(event_handler, path="."):
+    """ Start a native observer, falling back to polling if inotify runs out of watches or instances """
+    observer = Observer()
+    try:
+        schedule_watches(observer, event_handler, path)
+        observer.start()
+    except OSError as e:
+        if e.errno not in (errno.ENOSPC, errno.EMFILE):
+            raise
+        logger.warning("⚠️ inotify limit reached (fs.inotify.max_user_watches / max_user_instances), falling back to polling...")
+        observer.stop()
+        observer = PollingObserver(timeout=POLLING_INTERVAL)
+        schedule_watches(observer, event_handler, path)
+        observer.start()
+    return observer
 
 def watch():
-    global sam_process
-    print("🏗️ Initial build and start...")
+    logging.basicConfig(level=os.environ.get("BUDGET_BOT_LOG", "INFO").upper(), format="%(message)s")
+    logger.info("🏗️ Initial build and start...")
     restart_sam()  # Start the API initially
 
     path = "."  # Watch current directory
     event_handler = FileChangeHandler()
-    observer = Observer()
-    observer.schedule(event_handler, path, recursive=True)
-    observer.start()
+    observer = start_observer(event_handler, path)
+
+    # Sleep until SIGINT/SIGTERM instead of waking up every second
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    controller.install_reaper()
 
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("\n🛑 Stopping watcher...")
+        stop_event.wait()
+        logger.info("\n🛑 Stopping watcher...")
+    finally:
         observer.stop()
-        if sam_process:
-            sam_process.terminate()
-            sam_process.wait()
-    observer.join()
+        controller.stop()
+        observer.join()
 
 if __name__ == "__main__":
     watch()
\ No newline at end of file
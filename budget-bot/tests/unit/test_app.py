@@ -0,0 +1,230 @@
+import random
+import re
+
+import pytest
+
+from budget_bot import app
+
+
+# Reference implementations: the original, straightforward versions of the routing,
+# category and amount helpers. The optimized versions in app.py must agree with them.
+
+def reference_route(text):
+    """ Route as the handler originally did: deletion, then query, then the query guard """
+    text_lower = text.lower()
+
+    deletion_keywords = ["delete", "remove", "erase", "clear", "clean", "wipe", "purge"]
+    target_phrases = ["expense", "expenses", "history", "data", "records", "transactions"]
+    if any(k in text_lower for k in deletion_keywords) and any(p in text_lower for p in target_phrases):
+        return "delete"
+
+    for show_variant in ["show", "shwo", "shoq", "sho", "sbow"]:
+        direct_queries = [f"{show_variant} my expenses", f"{show_variant} expenses", f"{show_variant} my transactions"]
+        if any(query in text_lower for query in direct_queries):
+            return "query"
+    other_direct_queries = [
+        "my expenses", "what did i spend", "how much did i spend",
+        "total expenses", "expense report", "spending summary"
+    ]
+    if any(query in text_lower for query in other_direct_queries):
+        return "query"
+    query_keywords = [
+        "show", "shwo", "list", "display", "tell me", "what", "how much",
+        "total", "summary", "report", "analysis", "breakdown"
+    ]
+    expense_terms = ["expense", "spent", "spend", "cost", "payment"]
+    if any(k in text_lower for k in query_keywords) and any(t in text_lower for t in expense_terms):
+        return "query"
+
+    if re.search(r'(?:show|display|list|my expenses|total)', text_lower):
+        return "guarded"
+    return None
+
+
+def reference_category(text):
+    """ Emoji checks, then the first category (in order) with any keyword in the text.
+    Emojis match with or without the U+FE0F variation selector """
+    text_lower = text.lower()
+
+    def has_emoji(emojis):
+        return any(emoji.rstrip("\ufe0f") in text for emoji in emojis)
+
+    if has_emoji(["💻", "📱", "⌚", "🖥️", "🖨️", "📷", "🎮"]):
+        return 'Electronics'
+    if has_emoji(["🍕", "🍔", "🍟", "🍗", "🍖", "🥗", "🍣", "🍩", "🍦", "🍨", "🧁", "🍰", "🍪"]):
+        return 'Food'
+    if has_emoji(["🚗", "🚕", "🚌", "🚆", "✈️", "🛵", "🚲", "🚅", "🚄"]):
+        return 'Transport'
+    for category, keywords in app._CATEGORY_KEYWORDS.items():
+        if any(keyword in text_lower for keyword in keywords):
+            return category
+    return 'Miscellaneous'
+
+
+def reference_extract_inr_amount(text):
+    """ First number in the text, scaled by a multiplier word right after it """
+    text = text.replace(',', '').lower().strip()
+    match = re.search(r'(\d+(\.\d+)?)\s*(k|thousand|l|lakh|lakhs|cr|crore|crores)?', text, re.IGNORECASE)
+    if not match:
+        return None
+    amount = float(match.group(1))
+    multiplier = match.group(3)
+    if multiplier in ('k', 'thousand'):
+        amount *= 1_000
+    elif multiplier in ('l', 'lakh', 'lakhs'):
+        amount *= 100_000
+    elif multiplier in ('cr', 'crore', 'crores'):
+        amount *= 10_000_000
+    return amount
+
+
+def reference_format_inr(amount):
+    """ Thousands separators; decimals only when the original value had some """
+    try:
+        if isinstance(amount, str):
+            amount = float(amount.replace(',', ''))
+        num = float(amount)
+        return "{:,.2f}".format(num).rstrip('0').rstrip('.') if '.' in str(amount) else "{:,.0f}".format(num)
+    except Exception:
+        return "???"
+
+
+ROUTING_WORDS = (
+    "delete remove erase clear clean wipe purge expense expenses history data records transactions "
+    "show shwo shoq sho sbow my what did i spend how much total report spending summary list display "
+    "tell me analysis breakdown spent cost payment coffee uber 100 500 lunch"
+).split() + ["", "\n", "SHOW", "Delete"]
+
+CATEGORY_WORDS = [
+    keyword for keywords in app._CATEGORY_KEYWORDS.values() for keyword in keywords
+] + ["servic", "bil", "phon", "foo", "carpet", "scarf", "teacup", "500", "paid", "for", "",
+     "💻", "🍕", "🚗", "✈️", "✈", "🖥️", "🎮", "₹"]
+
+AMOUNT_CHARS = list("0123456789., \tkKlLcCrRtTfx₹٣\n") + ["thousand", "lakh", "lakhs", "crore", "cr ", "Cr", "k", "L"]
+
+
+def random_texts(words, seed, count=5000, max_words=6, joiners=(" ", "")):
+    rng = random.Random(seed)
+    for _ in range(count):
+        text = rng.choice(joiners).join(rng.choice(words) for _ in range(rng.randint(0, max_words)))
+        yield rng.choice([text, text.upper(), text.title()])
+
+
+@pytest.mark.parametrize("text, route", [
+    ("delete my expenses", "delete"),
+    ("clear history", "delete"),
+    ("show my expenses", "query"),
+    ("sbow expenses from last week", "query"),
+    ("how much did I spend today", "query"),
+    ("total payment", "query"),
+    ("display", "guarded"),
+    ("list of things", "guarded"),
+    ("coffee 100", None),
+    ("uber 300", None),
+])
+def test_route_message_examples(text, route):
+    assert app.route_message(text.lower()) == route
+    assert reference_route(text) == route
+
+
+def test_route_message_matches_reference():
+    for text in random_texts(ROUTING_WORDS, seed=1):
+        assert app.route_message(text.lower()) == reference_route(text), text
+
+
+@pytest.mark.parametrize("text, category", [
+    ("coffee 100", "Food"),
+    ("uber 250", "Transport"),
+    ("phone bill 499", "Bills"),  # Bills comes before Electronics
+    ("new phone 20k", "Electronics"),
+    ("bike service", "Vehicle"),
+    ("teacup set", "Food"),  # "tea" inside another word still counts
+    ("💻 50000", "Electronics"),
+    ("🍕🚗 300", "Food"),
+    ("✈ 8000", "Transport"),  # Without the variation selector
+    ("rent 15000", "Miscellaneous"),
+])
+def test_determine_fallback_category_examples(text, category):
+    assert app.determine_fallback_category(text) == category
+    assert reference_category(text) == category
+
+
+def test_determine_fallback_category_matches_reference():
+    for text in random_texts(CATEGORY_WORDS, seed=2):
+        assert app.determine_fallback_category(text) == reference_category(text), text
+
+
+@pytest.mark.parametrize("text, amount", [
+    ("coffee 100", 100.0),
+    ("rent 1.5L", 150_000.0),
+    ("car 2 cr", 20_000_000.0),
+    ("laptop 75k", 75_000.0),
+    ("1,250.50 groceries", 1250.5),
+    ("5 lakhs", 500_000.0),
+    ("3. apples", 3.0),
+    ("no amount here", None),
+])
+def test_extract_inr_amount_examples(text, amount):
+    assert app.extract_inr_amount(text) == amount
+    assert reference_extract_inr_amount(text) == amount
+
+
+def test_extract_inr_amount_matches_reference():
+    rng = random.Random(3)
+    for _ in range(20000):
+        text = "".join(rng.choice(AMOUNT_CHARS) for _ in range(rng.randint(0, 10)))
+        assert app.extract_inr_amount(text) == reference_extract_inr_amount(text), text
+
+
+@pytest.mark.parametrize("text, amount, category", [
+    ("coffee 200", "200", "Food"),
+    ("Uber 350.", "350", "Transport"),
+    ("laptop 50k", "50,000", "Electronics"),
+    ("₹500 lunch", "500", "Food"),
+])
+def test_fast_classify_accepts(text, amount, category):
+    result = app.fast_classify(text)
+    assert result["amount"] == amount
+    assert result["category"] == category
+
+
+@pytest.mark.parametrize("text", [
+    "coffee 200 300",  # More than one number
+    "laptop 50 k",  # Detached multiplier
+    "coffee uber 200",  # Keywords from two categories
+    "fuel 2000",  # The Gemini prompt files fuel under Transport
+    "petrol 1500",
+    "groceries 800",  # Listed under both Food and Groceries in the prompt
+    "rent 15000",  # No category keyword
+    "coffee",  # No number
+    "coffee with friends at the new place 200",  # Too long
+])
+def test_fast_classify_rejects(text):
+    assert app.fast_classify(text) is None
+
+
+@pytest.mark.parametrize("amount, formatted", [
+    (1500, "1,500"),
+    (1500.0, "1,500"),
+    (1500.5, "1,500.5"),
+    (1500.256, "1,500.26"),
+    ("1,23,456.00", "123,456"),
+    ("abc", "???"),
+])
+def test_format_inr_examples(amount, formatted):
+    assert app.format_inr(amount) == formatted
+    assert reference_format_inr(amount) == formatted
+
+
+def test_format_inr_matches_reference():
+    rng = random.Random(4)
+    for _ in range(20000):
+        value = rng.choice([
+            rng.randint(0, 10**9),
+            round(rng.uniform(0, 10**7), rng.randint(0, 4)),
+            rng.uniform(0, 1e-6),
+            float(rng.randint(0, 10**6)),
+            1e16 * rng.randint(1, 9),
+        ])
+        for amount in (value, str(value), f"{value:,}"):
+            assert app.format_inr(amount) == reference_format_inr(amount), amount
@@ -2,7 +2,7 @@ import json
 
 import pytest
 
-from hello_world import app
+from budget_bot import app
 
 
 @pytest.fixture()
@@ -67,6 +67,7 @@ def test_lambda_handler(apigw_event):
     ret = app.lambda_handler(apigw_event, "")
     data = json.loads(ret["body"])
 
-    assert ret["statusCode"] == 200
+    # Not a Telegram update: no chat id or text
+    assert ret["statusCode"] == 400
     assert "message" in ret["body"]
-    assert data["message"] == "hello world"
+    assert data["message"] == "Invalid request"
@@ -23,6 +23,13 @@ resource "aws_dynamodb_table" "processed_messages" {
     type = "S"
   }
 
+  # Epoch-seconds expiry on processed-message markers (MSG#<id>) and pending
+  # deletion confirmations (CONF#<username>); expense items never set it
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
   global_secondary_index {
     name            = "username-timestamp-index"
     hash_key        = "username"